@@ -16,7 +16,7 @@
 # TODO: Add   sessoin.status, session.headers, session.links(), session.scrape()
 # TODO: Add   session.select() to select a form before submit
 
-import mimetypes, re, os, sys, time, json, random, hashlib, base64, socket, tempfile, webbrowser
+import mimetypes, re, os, sys, string, collections, time, json, random, hashlib, base64, socket, tempfile, webbrowser
 from   wwwclient import client, defaultclient, scrape, agents
 
 if sys.version_info.major < 3:
@@ -32,15 +32,24 @@ else:
 HTTP                = "http"
 HTTPS               = "https"
 PROTOCOLS           = (HTTP, HTTPS)
+PROTOCOLS_BY_NAME   = dict((_, _) for _ in PROTOCOLS)
 
 GET                 = "GET"
 POST                = "POST"
 HEAD                = "HEAD"
 METHODS             = (GET, POST, HEAD)
+# Maps method names to the constants above, so that methods can be compared
+# by identity
+METHODS_BY_NAME     = dict((_, _) for _ in METHODS)
 DEFAULT_HTTP_CLIENT =  defaultclient.HTTPClient
 
 FILE_ATTACHMENT     = client.FILE_ATTACHMENT
 CONTENT_ATTACHMENT  = client.CONTENT_ATTACHMENT
+# Characters that 'urllib.quote_plus' leaves untouched
+URL_SAFE            = frozenset(string.ascii_letters + string.digits + "_.-")
+# Absolute URL with a path, no fragment and no empty query, as (protocol,
+# host, path, query)
+RE_ABSOLUTE_URL     = re.compile(r"^(https?)://([^/?#]+)(/[^?#]*)?(\?[^#]+)?$")
 
 def quote(path):
 	return url_quote(path, '/%')
@@ -86,16 +95,39 @@ def retry( function, times=5, wait=(0.1, 0.5, 1, 1.5, 2), exception=None):
 #
 # -----------------------------------------------------------------------------
 
-class Pairs:
+class Pairs(object):
 	"""Pairs are list of pairs (name,values) quite similar to
 	dictionaries, excepted that there can be multiple values for a single key,
 	and that the order of the keys is preserved. They can be easily converted to
 	URL parameters, headers and cookies."""
 
+	# Pairs are created several times per transaction, so we use slots to
+	# keep their instantiation and attribute access cheap.
+	__slots__ = ("pairs", "_index", "_seen", "_rev")
+
 	def __init__( self, params=None ):
-		self.pairs = []
+		self.pairs  = []
+		# Maps the normalized (lowercase, stripped) names to their values, so
+		# that lookups do not need to scan the pairs.
+		self._index = {}
+		# Set of the (name,value) pairs, used to avoid adding duplicates
+		self._seen  = set()
+		# Revision number, incremented on every change so that derived values
+		# can be cached.
+		self._rev   = 0
 		self.merge(params)
 
+	@classmethod
+	def fromList( cls, pairs ):
+		"""Creates pairs from the given list of (name,value) pairs, which is
+		expected to have no duplicates. This is faster than creating the pairs
+		through 'merge', as the pairs are not checked one by one."""
+		res       = cls.__new__(cls)
+		res.pairs = list(pairs)
+		res._rev  = 0
+		res._reindex()
+		return res
+
 	def set( self, name, value=None, replace=False ):
 		"""Sets the given name to hold the given value. Every previous value set
 		or added to the given name will be cleared."""
@@ -108,49 +140,83 @@ class Pairs:
 				self.add(name,value)
 			else:
 				self.pairs[i] = (name,value)
+				self._reindex()
+				self._rev += 1
 		else:
 			self.add(name, value)
 
 	def get( self, name ):
 		"""Gets the pair with the given name (case-insensitive)"""
-		for key, value in self.pairs:
-			if name.lower().strip() == key.lower().strip():
-				return value
-		return None
+		values = self._index.get(name.lower().strip())
+		return values[0] if values else None
 
 	def has( self, name ):
 		"""Tells if the pair has a field with the given name
 		(case-insensitive)"""
-		for key, value in self.pairs:
-			if name.lower().strip() == key.lower().strip():
-				return True
-		return False
+		return name.lower().strip() in self._index
 
 	def add( self, name, value=None ):
 		"""Adds the given value to the given name. This does not destroy what
 		already existed. (if the pair already exists, it is not added twice."""
 		if type(name) == tuple and len(name) == 2:
-			if name not in self.pairs: self.pairs.append(name)
+			pair = name
 		else:
 			pair = (name,value)
-			if pair not in self.pairs: self.pairs.append((name, value))
+		try:
+			if pair in self._seen: return
+			self._seen.add(pair)
+		except TypeError:
+			# Pairs with unhashable values (ie. lists) are checked by scanning
+			if pair in self.pairs: return
+		self.pairs.append(pair)
+		name = pair[0]
+		key  = name.lower().strip() if isinstance(name, (str, unicode)) else name
+		self._index.setdefault(key, []).append(pair[1])
+		self._rev += 1
 
 	def clear( self, name ):
 		"""Clears all the (name,values) pairs which have the given name."""
-		self.pairs = filter(lambda x:x[0]!= name, self.pairs)
+		self.pairs = [_ for _ in self.pairs if _[0] != name]
+		self._reindex()
+		self._rev += 1
+
+	def _reindex( self ):
+		"""Rebuilds the name index and the set of pairs from the current
+		pairs."""
+		self._index = {}
+		self._seen  = set()
+		for pair in self.pairs:
+			name, value = pair
+			key = name.lower().strip() if isinstance(name, (str, unicode)) else name
+			self._index.setdefault(key, []).append(value)
+			# Unhashable pairs are left out, 'add' scans the list for them
+			try:
+				self._seen.add(pair)
+			except TypeError:
+				pass
 
 	def merge( self, parameters ):
 		"""Merges the given parameters into this parameters list."""
-		if parameters == None: return self
-		if type(parameters) == dict:
+		if parameters is None: return self
+		if isinstance(parameters, Pairs):
+			if not self.pairs:
+				# The given pairs have no duplicates, so they can be copied
+				# as-is when there is nothing to merge with.
+				self.pairs = list(parameters.pairs)
+				self._reindex()
+				self._rev += 1
+			else:
+				for name, value in parameters.pairs:
+					self.add(name, value)
+		elif isinstance(parameters, dict):
 			for name, value in parameters.items():
 				self.add(name, value)
-		elif type(parameters) in (tuple, list):
+		elif isinstance(parameters, (tuple, list)):
 			for v in parameters:
-				if type(v) in (tuple, list):
+				if isinstance(v, (tuple, list)):
 					name, value = v
 					self.add(name, value)
-				elif type(v) in (str, unicode):
+				elif isinstance(v, (str, unicode)):
 					if v:
 						name_value = v.split(":", 1)
 						value      = None
@@ -161,30 +227,40 @@ class Pairs:
 						self.add(name.strip(), value.strip())
 				else:
 					raise Exception("Pair.merge: Unsupported type for merging %s" % (parameters))
-		elif type(parameters) in (str, unicode):
+		elif isinstance(parameters, (str, unicode)):
 			return self.merge(parameters.split("\n"))
-		elif isinstance(parameters, Pairs):
-			for name, value in parameters.pairs:
-				self.add(name, value)
 		else:
 			raise Exception("Pair.merge: Unsupported type for merging %s" % (parameters))
 		return self
 
 	def asURL( self ):
 		"""Returns an URL-encoded version of this parameters list."""
-		return urllib.urlencode(self.pairs)
+		# Most parameters have nothing to be quoted, in which case we can
+		# skip the encoding altogether.
+		for k, v in self.pairs:
+			if not (type(k) is str and type(v) is str and URL_SAFE.issuperset(k) and URL_SAFE.issuperset(v)):
+				return urllib.urlencode(self.pairs)
+		return "&".join(k + "=" + v for k, v in self.pairs)
 
 	def asFormData( self ):
 		"""Returns an URL-encoded version of this parameters list."""
-		return urllib.urlencode(self.pairs)
+		return self.asURL()
 
 	def asHeaders( self ):
 		"""Returns a list of header strings."""
-		return list("%s: %s" % (k,v) for k,v in self.pairs)
+		# Concatenation is faster than formatting, but only works when
+		# names and values are all strings.
+		try:
+			return [k + ": " + v for k,v in self.pairs]
+		except TypeError:
+			return ["%s: %s" % (k,v) for k,v in self.pairs]
 
 	def asCookies( self ):
 		"""Returns these pairs as cookies"""
-		return "; ".join("%s=%s" % (k,v) for k,v in self.pairs)
+		try:
+			return "; ".join([k + "=" + v for k,v in self.pairs])
+		except TypeError:
+			return "; ".join(["%s=%s" % (k,v) for k,v in self.pairs])
 
 	def asFields( self ):
 		"""Returns a list of (name, value) couples."""
@@ -202,6 +278,111 @@ class Pairs:
 	def __repr__(self):
 		return repr(self.pairs)
 
+class CookieJar(object):
+	"""A cookie jar maps cookie names to their values. Unlike 'Pairs', there
+	is only one value per cookie (the last one set wins), so merging cookies
+	does not need to check for duplicates. Cookies are kept in the order in
+	which they were first set.
+
+	Cookie jars offer the same methods as 'Pairs', except that 'get' and
+	'has' match the cookie name exactly, as cookie names are
+	case-sensitive."""
+
+	__slots__ = ("cookies", "_rev")
+
+	def __init__( self, cookies=None ):
+		self.cookies = collections.OrderedDict()
+		# Revision number, incremented on every change so that derived values
+		# can be cached.
+		self._rev    = 0
+		self.merge(cookies)
+
+	@property
+	def pairs( self ):
+		"""Returns a read-only snapshot of the cookies as a tuple of (name,
+		value) pairs. The jar is not changed through it: use 'add', 'set',
+		'clear' or 'merge' instead."""
+		return tuple(self.cookies.items())
+
+	def set( self, name, value=None, replace=False ):
+		"""Sets the cookie with the given name to the given value."""
+		self.add(name, value)
+
+	def get( self, name ):
+		"""Gets the value of the cookie with the given name (case-sensitive)."""
+		return self.cookies.get(name)
+
+	def has( self, name ):
+		"""Tells if there is a cookie with the given name (case-sensitive)."""
+		return name in self.cookies
+
+	def add( self, name, value=None ):
+		"""Sets the cookie with the given name to the given value, replacing
+		its previous value."""
+		if type(name) == tuple and len(name) == 2:
+			name, value = name
+		self._update(((name, value),))
+
+	def clear( self, name ):
+		"""Removes the cookie with the given name."""
+		if name in self.cookies:
+			del self.cookies[name]
+			self._rev += 1
+
+	def merge( self, cookies ):
+		"""Merges the given cookies (a cookie jar, a dictionary, a list of
+		(name, value) pairs or anything accepted by 'Pairs') into this cookie
+		jar."""
+		if not cookies: return self
+		if isinstance(cookies, CookieJar):
+			self._update(cookies.cookies.items())
+		elif isinstance(cookies, dict):
+			self._update(cookies.items())
+		elif isinstance(cookies, Pairs):
+			self._update(cookies.pairs)
+		elif isinstance(cookies, (tuple, list)) and all(type(_) is tuple and len(_) == 2 for _ in cookies):
+			# Lists of (name, value) pairs, like the new cookies returned by
+			# the HTTP clients, are used as-is, without going through 'Pairs'.
+			self._update(cookies)
+		else:
+			self._update(Pairs(cookies).pairs)
+		return self
+
+	def _update( self, items ):
+		"""Sets the given (name, value) pairs. The revision is only incremented
+		when a cookie was actually added or changed, so that merging the same
+		cookies again keeps the derived values cached."""
+		cookies = self.cookies
+		changed = False
+		for name, value in items:
+			if name not in cookies or cookies[name] != value:
+				cookies[name] = value
+				changed       = True
+		if changed: self._rev += 1
+
+	def asCookies( self ):
+		"""Returns these cookies as the value of a 'Cookie' header."""
+		try:
+			return "; ".join([k + "=" + v for k,v in self.cookies.items()])
+		except TypeError:
+			return "; ".join(["%s=%s" % (k,v) for k,v in self.cookies.items()])
+
+	def asFields( self ):
+		"""Returns a list of (name, value) couples."""
+		return list(self.cookies.items())
+
+	def __getitem__( self, k ):
+		if type(k) == int:
+			return self.pairs[k]
+		else:
+			return self.get(k)
+
+	def __len__(self):
+		return len(self.cookies)
+
+	def __repr__(self):
+		return repr(self.pairs)
+
 # -----------------------------------------------------------------------------
 #
 # HTTP REQUEST WRAPPER
@@ -237,16 +418,30 @@ class Request:
 			raise Exception("Expected file or content")
 
 	def __init__( self, method=GET, url =None, host=None, fields=None, attach=(),
-	params=None, headers=None, data=None,  cookies=None, mimetype=None ):
-		self._method      = method.upper()
+	params=None, headers=None, data=None,  cookies=None, mimetype=None,
+	defaultHeaders=None ):
+		"""Creates a new request. The 'defaultHeaders' (a 'Pairs' instance) are
+		copied as-is, and are replaced by the given 'headers' (or the ones set
+		later) that have the same name."""
+		method            = method.upper()
+		self._method      = METHODS_BY_NAME.get(method, method)
 		self._url         = url
 		self._params      = Pairs(params)
-		self._cookies     = Pairs().merge(cookies)
-		self._headers     = Pairs(headers)
+		self._cookies     = CookieJar(cookies)
+		self._headers     = Pairs(defaultHeaders)
+		# Normalized names of the default headers that were not overridden yet
+		self._defaultNames = set(defaultHeaders._index) if defaultHeaders else None
 		self._data        = data
 		self._fields      = Pairs(fields)
 		self._attachments = []
+		self._urlCache    = None
+		self._headersCache = None
 		if attach: self._attachments.extend(attach)
+		if self._defaultNames:
+			for name, value in Pairs(headers).pairs:
+				self._setHeader(name, value)
+		else:
+			self._headers.merge(headers)
 		# Ensures that the method is a proper one
 		if self._method not in METHODS:
 			raise Exception("Method not supported: %s" % (method))
@@ -259,13 +454,19 @@ class Request:
 
 	def url( self ):
 		"""Returns this request url, including the parameters"""
-		if self._params.pairs:
-			if self._method == POST and self._data != None or self._attachments:
-				return self._url
-			else:
-				return self._url + "?" + self._params.asURL()
-		else:
+		if not self._params.pairs:
 			return self._url
+		# The encoded URL only changes when the parameters, method, data or
+		# attachments change, so we cache it.
+		key = (self._params._rev, self._method, self._data != None, bool(self._attachments))
+		if self._urlCache and self._urlCache[0] == key:
+			return self._urlCache[1]
+		if self._method is POST and self._data != None or self._attachments:
+			url = self._url
+		else:
+			url = self._url + "?" + self._params.asURL()
+		self._urlCache = (key, url)
+		return url
 
 	def params( self ):
 		"""Returns the params attached to this request. The params are returned
@@ -278,7 +479,7 @@ class Request:
 		return self._fields
 
 	def cookies( self ):
-		"""Returns the cookies defined in this request, as a 'Pair' instance (if any)."""
+		"""Returns the cookies defined in this request, as a 'CookieJar'."""
 		return self._cookies
 
 	def header( self, name, value=client, replace=False ):
@@ -286,19 +487,46 @@ class Request:
 		if value == client:
 			return self._headers.get(name)
 		else:
-			self._headers.set(name, str(value), replace=False)
+			self._setHeader(name, str(value))
+
+	def _setHeader( self, name, value ):
+		"""Adds the given header, replacing the default header with the same
+		name, if any."""
+		key = name.lower().strip()
+		if self._defaultNames and key in self._defaultNames:
+			self._defaultNames.discard(key)
+			self._headers.set(name, value, replace=True)
+		else:
+			self._headers.add(name, value)
 
 	def headers( self ):
 		"""Returns the headers for this request as a Pairs instance."""
-		headers = Pairs(self._headers)
-		# Takes care of cookies
-		if self._cookies.pairs:
-			cookie_header = headers.get("Cookie")
-			if cookie_header:
-				headers.set("Cookie", cookie_header + "; " + self._cookies.asCookies())
+		headers = list(self._headers.pairs)
+		# Takes care of cookies, which are appended to the existing Cookie
+		# header, if any.
+		if self._cookies:
+			cookies = self._cookies.asCookies()
+			# The index tells us if there is a Cookie header, so we only
+			# look for it when there is one.
+			if self._headers.has("Cookie"):
+				for i, (name, value) in enumerate(headers):
+					if name.lower().strip() == "cookie":
+						headers[i] = (name, value + "; " + cookies)
+						break
 			else:
-				headers.set("Cookie", self._cookies.asCookies())
-		return headers
+				headers.append(("Cookie", cookies))
+		return Pairs.fromList(headers)
+
+	def asHeaders( self ):
+		"""Returns the headers for this request as a list of header strings,
+		as expected by the HTTP clients."""
+		# The list only changes when the headers or cookies change, so we
+		# cache it.
+		key = (self._headers._rev, self._cookies._rev)
+		if not self._headersCache or self._headersCache[0] != key:
+			self._headersCache = (key, self.headers().asHeaders())
+		# Clients may add headers to the list, so we return a copy
+		return list(self._headersCache[1])
 
 	def data( self, data=client ):
 		"""Sets the urlencoded data for this request. The request will be
@@ -352,7 +580,7 @@ class Transaction:
 		self._session    = session
 		self._request    = request
 		self._status     = None
-		self._cookies    = Pairs()
+		self._cookies    = CookieJar()
 		self._newCookies = None
 		self._done       = False
 		self._responses  = []
@@ -443,9 +671,7 @@ class Transaction:
 		actually sends the data to the transport layer."""
 		# We do not do a transaction twice
 		if self._done: return
-		# We prepare the headers
 		request  = self.request()
-		headers  = request.headers()
 		response = None
 		# if self._verbose >= 1:
 		# 	self._session._log(request.method(), request.url())
@@ -453,32 +679,35 @@ class Transaction:
 		request.cookies().merge(self.session().cookies())
 		# As well as this transaction cookies
 		request.cookies().merge(self.cookies())
+		# We prepare the headers once the cookies are merged
+		headers  = request.asHeaders()
+		method   = request.method()
 		# We send the request as a GET
-		if request.method() == GET:
+		if method is GET:
 			responses = self._client.GET(
 				request.url(),
-				headers=request.headers().asHeaders()
+				headers=headers
 			)
-		elif request.method() == HEAD:
+		elif method is HEAD:
 			responses = self._client.HEAD(
 				request.url(),
-				headers=request.headers().asHeaders()
+				headers=headers
 			)
 		# Or as a POST
-		elif request.method() == POST:
+		elif method is POST:
 			responses = self._client.POST(
 				request.url(),
 				data=request.data(),
 				attach=request.attachments(),
 				fields=request.fields().asFields(),
-				headers=request.headers().asHeaders()
+				headers=headers
 			)
 		# The method may be unsupported
 		else:
-			raise Exception("Unsupported method:", request.method())
+			raise Exception("Unsupported method:", method)
 		# We merge the new cookies if necessary
 		self._status     = self._client.status()
-		self._newCookies = Pairs(self._client.newCookies())
+		self._newCookies = CookieJar(self._client.newCookies())
 		self._done       = True
 		self._responses += responses
 		return self
@@ -550,20 +779,21 @@ class Session:
 		self._host            = None
 		self._port            = 80
 		self._protocol        = None
-		self._transactions    = []
-		self._cookies         = Pairs()
-		self._userAgent       = "Mozilla/5.0 (X11; U; Linux i686; fr; rv:1.8.0.4) Gecko/20060608 Ubuntu/dapper-security"
 		self._maxTransactions = self.MAX_TRANSACTIONS
+		self._transactions    = collections.deque(maxlen=self._maxTransactions)
+		self._cookies         = CookieJar()
+		self._userAgent       = "Mozilla/5.0 (X11; U; Linux i686; fr; rv:1.8.0.4) Gecko/20060608 Ubuntu/dapper-security"
 		self._referer         = None
 		self._verbose         = None
 		self._onLog           = None
 		self._follow          = follow
 		self._do              = do
 		self._delay           = delay
-		self._headers         = []
+		# Headers sent with every request (ie. user agent and authentication)
+		self._headers         = Pairs()
 		self._throwExceptions = True
 		if type(personality) in (unicode,str): personality = Personality.Get(personality)
-		self._personality     = personality
+		self.setPersonality(personality)
 		self.MERGE_COOKIES    = True
 		self.verbose(verbose)
 		if url: self.get(url)
@@ -588,8 +818,8 @@ class Session:
 	def auth( self, user, passwd ):
 		"""Adds an HTTP Authentication header to the curent session based on the given
 		user and password."""
-		self._headers = filter(lambda _:_[0]!="Authorization", self._headers)
-		self._headers.append(("Authorization", "Basic " + base64.b64encode(user + ":" + passwd)))
+		self._headers.clear("Authorization")
+		self._headers.add("Authorization", "Basic " + base64.b64encode(user + ":" + passwd))
 		return self
 
 	def setLogger( self, callback ):
@@ -604,7 +834,12 @@ class Session:
 		return self.setPersonality(Firefox())
 
 	def setPersonality( self, personality ):
+		"""Binds the given personality to this session. The personality user
+		agent (or the session one if there is no personality) is sent with
+		every request."""
 		self._personality = personality
+		user_agent        = personality.userAgent() if personality else self._userAgent
+		self._headers.set("User-Agent", user_agent, replace=True)
 		return personality
 
 	def personality( self ):
@@ -764,16 +999,16 @@ class Session:
 					else:
 						return self._failTransaction(transaction, e)
 			if self.MERGE_COOKIES: self._cookies.merge(transaction.newCookies())
-			visited   = [url]
+			visited   = set((url,))
 			iteration = 0
-			while transaction.redirect() and follow and iteration < self.REDIRECT_LIMIT:
-				redirect_url = self.__processURL(transaction.redirect(), store=False)
-				if not (redirect_url in visited):
-					visited.append(redirect_url)
-					transaction = self.get(redirect_url, headers=headers, cookies=cookies, do=True, method=method, follow=False)
-					iteration  += 1
-				else:
-					break
+			redirect  = transaction.redirect()
+			while redirect and follow and iteration < self.REDIRECT_LIMIT:
+				redirect_url = self.__processURL(redirect, store=False)
+				if redirect_url in visited: break
+				visited.add(redirect_url)
+				transaction = self.get(redirect_url, headers=headers, cookies=cookies, do=True, method=method, follow=False)
+				iteration  += 1
+				redirect    = transaction.redirect()
 		return transaction
 
 	def _failTransaction( self, transaction, exception ):
@@ -822,14 +1057,14 @@ class Session:
 						time.sleep(r)
 			if self.MERGE_COOKIES: self._cookies.merge(transaction.newCookies())
 			# And follow the redirect if any
-			visited = [url]
-			while transaction.redirect() and follow:
-				redirect_url = self.__processURL(transaction.redirect(), store=False)
-				if not (redirect_url in visited):
-					visited.append(redirect_url)
-					transaction = self.post(redirect_url, data=data, mimetype=mimetype, fields=fields, attach=attach, headers=headers, cookies=cookies, do=True)
-				else:
-					break
+			visited  = set((url,))
+			redirect = transaction.redirect()
+			while redirect and follow:
+				redirect_url = self.__processURL(redirect, store=False)
+				if redirect_url in visited: break
+				visited.add(redirect_url)
+				transaction = self.post(redirect_url, data=data, mimetype=mimetype, fields=fields, attach=attach, headers=headers, cookies=cookies, do=True)
+				redirect    = transaction.redirect()
 		return transaction
 
 	def submit( self, form, values={}, attach=[], action=None,  method=POST,
@@ -907,15 +1142,23 @@ class Session:
 		if url.startswith("//"): url = "http:" + url
 		if url == None and not self._transactions: url = "/"
 		if url == None and self._transactions: url = self.last().request.url()
+		# An absolute URL to the current host that already has a path is
+		# already normalized, so we can return it as-is.
+		match = RE_ABSOLUTE_URL.match(url)
+		if match and match.group(3) and match.group(2) == self._host:
+			if store:
+				self._protocol = match.group(1)
+				self._port     = None
+			return url
 		proto_rest = url.split("://",1)
 		if len(proto_rest) == 2 and proto_rest[0].find("/") == -1:
 			# If the URL was given with a protocol, then we might change server
-			protocol, host, path, parameters, query, fragment =  urlparse.urlparse(url)
+			protocol, host, path, query, fragment =  urlparse.urlsplit(url)
 		else:
 			# Otherwise we expect to be on the same server (and then just the
 			# path is given)
 			assert self._host, "No host was given to url: {0}".format(url)
-			protocol, host, path, parameters, query, fragment =  urlparse.urlparse(
+			protocol, host, path, query, fragment =  urlparse.urlsplit(
 				"%s://%s:%s%s" % (
 					(self._protocol or HTTP),
 					self._host,
@@ -923,8 +1166,7 @@ class Session:
 					url[0] == "/" and url or ("/" + url)
 			))
 		if store:
-			if   protocol == "http":  self._protocol = protocol = HTTP
-			elif protocol == "https": self._protocol = protocol = HTTPS
+			self._protocol = PROTOCOLS_BY_NAME.get(protocol, self._protocol)
 		port = None
 		if host:
 			host = host.split(":")
@@ -944,14 +1186,13 @@ class Session:
 		if   path and path[0] == "/": url += path
 		elif path:      url += "/" + path
 		else:           url += "/"
-		if parameters:  url += ";" + parameters
 		if query:       url += "?" + query
 		if fragment:    url += "#" + fragment
 		return url
 
 	def _createRequest( self, **kwargs ):
-		# We copyt the session headers (ie. authentication)
-		kwargs["headers"] = (kwargs.get("headers") or []) + self._headers
+		# We copy the session headers (ie. user agent and authentication)
+		kwargs["defaultHeaders"] = self._headers
 		request = Request(**kwargs)
 		last    = self.last()
 		if self.referer(): request.header("Referer", self.referer())
@@ -959,9 +1200,8 @@ class Session:
 		return request
 
 	def __addTransaction( self, transaction ):
-		"""Adds a transaction to this session."""
-		if len(self._transactions) > self._maxTransactions:
-			self._transactions = self._transactions[1:]
+		"""Adds a transaction to this session. The oldest transaction is
+		discarded once 'maxTransactions' is reached."""
 		self._transactions.append(transaction)
 
 # -----------------------------------------------------------------------------
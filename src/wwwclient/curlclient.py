@@ -127,8 +127,14 @@ class HTTPClient(client.HTTPClient):
 	def _prepareRequest( self, url, headers = None ):
 		"""Returns a pair (request, stringio) corresponding to an HTTP request
 		to the given url with the given headers (as a list of strings)"""
-		assert self._curl == None, "Only one request is allowed per instance"
-		c = self._curl = pycurl.Curl()
+		assert self._buffer == None, "Only one request is allowed at a time"
+		# We keep the same Curl handle for all the requests, so that Curl can
+		# reuse the connections it keeps alive.
+		if self._curl is None:
+			self._curl = pycurl.Curl()
+		else:
+			self._curl.reset()
+		c = self._curl
 		s = self._buffer = StringIO.StringIO()
 		c.setopt(c.URL, self._absoluteURL(url))
 		c.setopt(pycurl.FOLLOWLOCATION, 0)
@@ -158,8 +164,7 @@ class HTTPClient(client.HTTPClient):
 		self._url    = r.getinfo(pycurl.EFFECTIVE_URL)
 		self._protocol, self._host, _, _, _, _ = urlparse.urlparse(self._url)
 		self._parseResponse(self._buffer.getvalue())
-		self._curl.close()
-		self._curl = None
+		self._buffer = None
 		if self.verbose >= 1: print self.info(), "\n"
 
 	def curlEncode(self, fields=(), attach=()):
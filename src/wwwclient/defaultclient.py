@@ -12,7 +12,7 @@
 # Last mod  : 08-Mar-2013
 # -----------------------------------------------------------------------------
 
-import sys, logging
+import sys, socket, select, logging
 import wwwclient.client as client
 
 if sys.version_info.major < 3:
@@ -27,12 +27,17 @@ class HTTPClient(client.HTTPClient):
 	"""Sends and manages HTTP requests using the 'http.client' and 'urllib.parse'
 	modules. Using the 'curlclient' may be more efficient than using this one."""
 
-	TIMEOUT = 10
+	TIMEOUT            = 10
+	IDEMPOTENT_METHODS = ("GET", "HEAD")
 
 	def __init__( self, encoding="utf-8" ):
 		client.HTTPClient.__init__(self, encoding)
 		self._encoding = encoding
-		self._http = None
+		self._http     = None
+		# The (protocol, host) the current connection is open to
+		self._httpKey  = None
+		# Tells if the last request was sent on a kept-alive connection
+		self._httpReused = False
 
 	def GET  ( self, url, headers=None ):
 		return self._request(url, headers, "GET")
@@ -60,9 +65,7 @@ class HTTPClient(client.HTTPClient):
 			response  = self._cache.get(url)
 			was_cache = True
 		if not response:
-			self._prepareRequest(method=method, url=url, headers=headers)
-			# And get the response
-			response = self._performRequest()
+			response = self._sendRequest(method=method, url=url, headers=headers)
 			if self._cache:
 				self._cache.set(url, response)
 		return self._finaliseRequest(response, url, method)
@@ -90,19 +93,32 @@ class HTTPClient(client.HTTPClient):
 			headers.append("Content-Type: " + mimetype)
 		# We add the Content-Length header to the headers list
 		headers.append("Content-Length: " + self._valueToString(len(data)))
-		# We prepare the request
-		self._prepareRequest(method=method, url=url, headers=headers, body=data)
-		# And get the response
-		response = self._performRequest()
+		response = self._sendRequest(method=method, url=url, headers=headers, body=data)
 		result   = self._finaliseRequest(response, url, method)
 		if self.verbose >= 1: self._log(self.info())
 		return result
 
+	def _sendRequest( self, url, headers=(), body=None, method="GET" ):
+		"""Prepares and performs the request, returning the response. When
+		the request was sent on a kept-alive connection that the server closed
+		in the meantime, it is retried once on a new connection."""
+		sent = False
+		try:
+			self._prepareRequest(method=method, url=url, headers=headers, body=body)
+			sent = True
+			return self._performRequest()
+		except socket.timeout:
+			raise
+		except (http_client.BadStatusLine, socket.error):
+			# Once sent, the request may have been processed by the server, so
+			# we only send it again if it is idempotent.
+			if not self._httpReused or sent and method not in self.IDEMPOTENT_METHODS: raise
+			self._prepareRequest(method=method, url=url, headers=headers, body=body)
+			return self._performRequest()
+
 	def _prepareRequest( self, url, headers=(), body=None, method="GET" ):
-		# We close any pre-existing connection
-		if self._http:
-			logging.warning("Client had previously unclosed connection: {0}".format(self._url))
-		self._closeConnection()
+		"""Sends the request, reusing the current connection if it is open
+		to the same host."""
 		self._url  = url
 		url_parsed = urlparse.urlparse(url)
 		host       = url_parsed[1] or self.host()
@@ -112,12 +128,22 @@ class HTTPClient(client.HTTPClient):
 		if i == -1:
 			raise Exception("URL does not correspond to current host (%s): %s " % (host, url))
 		url_path = url[i+len(host):]
-		if url_parsed[0] == "http":
-			self._http = http_client.HTTPConnection(host, timeout=self.TIMEOUT)
-		elif url_parsed[0] == "https":
-			self._http = http_client.HTTPSConnection(host, timeout=self.TIMEOUT)
-		else:
-			raise Exception("Protocol not supported: {0}".format(url_parsed[0]))
+		key      = (url_parsed[0], host)
+		# We keep the connection alive between requests to the same host.
+		# Requests that are not idempotent always get a new connection, as
+		# they cannot be safely sent again if the server drops a kept-alive
+		# connection.
+		if self._http and (self._httpKey != key or method not in self.IDEMPOTENT_METHODS or not self._isConnectionAlive()):
+			self._closeConnection()
+		self._httpReused = self._http is not None
+		if not self._httpReused:
+			if url_parsed[0] == "http":
+				self._http = http_client.HTTPConnection(host, timeout=self.TIMEOUT)
+			elif url_parsed[0] == "https":
+				self._http = http_client.HTTPSConnection(host, timeout=self.TIMEOUT)
+			else:
+				raise Exception("Protocol not supported: {0}".format(url_parsed[0]))
+		self._httpKey = key
 		http_headers = {}
 		for header in headers:
 			colon = header.find(":")
@@ -128,8 +154,23 @@ class HTTPClient(client.HTTPClient):
 		#print headers
 		#print body
 		#print "=---------------------------------------"
-		request  = self._http.request(method, url_path, body, http_headers)
-		return request
+		try:
+			self._http.request(method, url_path, body, http_headers)
+		except Exception as e:
+			self._closeConnection()
+			raise e
+
+	def _isConnectionAlive( self ):
+		"""Tells if the kept-alive connection can still be used. An idle
+		connection has nothing to read, so if its socket is readable the
+		server has closed it (or sent something unexpected)."""
+		sock = self._http.sock
+		if sock is None: return False
+		try:
+			readable, _, _ = select.select([sock], [], [], 0)
+		except (select.error, socket.error, ValueError):
+			return False
+		return not readable
 
 	def _performRequest( self, counter=0 ):
 		try:
@@ -144,7 +185,10 @@ class HTTPClient(client.HTTPClient):
 				msg    = response.msg,
 				body   = body
 			)
-			self._closeConnection()
+			# The connection is kept for the next request, unless the
+			# server asked for it to be closed
+			if response.will_close:
+				self._closeConnection()
 			return res
 		except Exception as e:
 			self._closeConnection()
@@ -156,12 +200,12 @@ class HTTPClient(client.HTTPClient):
 		self._status = response.split()[1]
 		res          = self._parseResponse(response)
 		self._protocol, self._host, _, _, _, _ = urlparse.urlparse(self._url)
-		self._closeConnection()
 		return res
 
 	def _closeConnection( self ):
 		if self._http:
 			self._http.close()
-			self._http = None
+			self._http    = None
+			self._httpKey = None
 
 # EOF - vim: tw=80 ts=4 sw=4 noet
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# Encoding: iso-8859-1
+# vim: tw=80 ts=4 sw=4 noet
+# Tests that kept-alive connections are reused, and that requests still go
+# through when the server drops a connection. Runs against a local server.
+from os.path import join, basename, dirname, abspath
+import sys ; sys.path.insert(0, join(dirname(dirname(abspath(__file__))), "src"))
+import time, threading, BaseHTTPServer, SocketServer
+from wwwclient import browse
+
+IDLE_TIMEOUT = 0.5
+REQUESTS     = []
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""An HTTP/1.1 handler that keeps connections alive, closes them after
+	'IDLE_TIMEOUT', and drops the connection without answering '/drop'."""
+
+	protocol_version = "HTTP/1.1"
+	timeout          = IDLE_TIMEOUT
+
+	def handle( self ):
+		try:
+			BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+		except Exception:
+			pass
+
+	def do_GET( self ):
+		self.reply()
+
+	def do_POST( self ):
+		self.rfile.read(int(self.headers.get("Content-Length") or 0))
+		self.reply()
+
+	def reply( self ):
+		REQUESTS.append((self.command, self.path, self.client_address))
+		if self.path == "/drop":
+			self.close_connection = 1
+			return
+		body = self.command + " " + self.path
+		self.send_response(200)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message( self, *args ):
+		pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+server = Server(("127.0.0.1", 0), Handler)
+thread = threading.Thread(target=server.serve_forever)
+thread.daemon = True
+thread.start()
+url = "http://127.0.0.1:%d" % (server.server_address[1])
+
+# Consecutive GETs reuse the same connection
+session = browse.Session(personality=None)
+assert session.get(url + "/a").data() == "GET /a"
+assert session.get(url + "/b").data() == "GET /b"
+assert REQUESTS[0][2] == REQUESTS[1][2], "Connection was not reused"
+
+# A POST after the server closed the idle connection goes through
+del REQUESTS[:]
+session = browse.Session(personality=None)
+session.get(url + "/a")
+time.sleep(IDLE_TIMEOUT * 2)
+assert session.post(url + "/x", data="a=b").data() == "POST /x"
+
+# A GET after the server closed the idle connection goes through
+session.get(url + "/a")
+time.sleep(IDLE_TIMEOUT * 2)
+assert session.get(url + "/b").data() == "GET /b"
+
+# A POST that the server drops is not sent twice
+del REQUESTS[:]
+session = browse.Session(personality=None)
+session.get(url + "/a")
+try:
+	session.post(url + "/drop", data="a=b")
+	assert False, "Expected the dropped POST to fail"
+except AssertionError:
+	raise
+except Exception:
+	pass
+assert [_[:2] for _ in REQUESTS].count(("POST", "/drop")) == 1, "POST was sent again"
+
+server.shutdown()
+print "OK"
+
+# EOF